@@ -4,12 +4,23 @@ Uses dithering to process a file.
 
 import os
 import sys
-from typing import Any, Callable
+from typing import Any, Callable, Optional
 import numpy as np
 import numpy.typing as npt
+import numba
+from numba import njit, prange
 from PIL import Image
 
 
+# numba names its cache files after the source file rather than the module, and kernels cached
+# while this file was imported as dithering.dither can't be loaded into __main__ (or the other
+# way around), so running this file as a script keeps its own cache, also when NUMBA_CACHE_DIR
+# is set.
+if __name__ == "__main__":
+    _cachedir = numba.config.CACHE_DIR or os.path.join(os.path.dirname(os.path.abspath(__file__)), "__pycache__")  # type: ignore
+    numba.config.CACHE_DIR = os.path.join(_cachedir, "script")  # type: ignore
+
+
 # error/usage messages
 def on_usage_error() -> None:
     """
@@ -70,11 +81,331 @@ def on_file_error(inputpath: str) -> None:
     exit(1)
 
 
-ColorLike = npt.NDArray[np.int32]
+ColorLike = npt.NDArray[np.integer[Any]]
+
+
+# the cells of ColorScheme._getCellCandidates
+_CELL_MARGIN = 32
+_CELLS = (256 + 2 * _CELL_MARGIN) // 8  # per channel
+_CELL_RANKS = 3
+# the tiles of _fs_wavefront_kernel, in rows and in values of x + y
+_TILE_ROWS = 32
+_TILE_COLUMNS = 128
+
+
+# compiled kernels
+@njit(cache=True, fastmath=True, inline="always")
+def _saturate16(value):  # type: ignore
+    """
+    Clamps value to the range of int16
+    """
+    return min(max(value, -32768), 32767)
+
+
+@njit(cache=True, fastmath=True)
+def _argmin_palette(cr, cg, cb, palette, exclude1, exclude2):  # type: ignore
+    """
+    Returns the index of the palette entry closest to the color (cr, cg, cb), skipping the indices
+    exclude1 and exclude2 (pass -1 to exclude nothing), by comparing it against every entry.
+    Returns -1 if every entry was excluded.
+    """
+    bestdist = np.iinfo(np.int64).max
+    bestidx = -1
+    for k in range(palette.shape[0]):
+        if k == exclude1 or k == exclude2:
+            continue
+        dr = cr - np.int64(palette[k, 0])
+        dg = cg - np.int64(palette[k, 1])
+        db = cb - np.int64(palette[k, 2])
+        d = dr*dr + dg*dg + db*db
+        if d < bestdist:
+            bestdist = d
+            bestidx = k
+    return bestidx
+
+
+@njit(cache=True, fastmath=True, inline="always")
+def _lookup_palette(cr, cg, cb, palette, offsets, candidates, exclude1, exclude2):  # type: ignore
+    """
+    Same as _argmin_palette, but only compares the color against the candidates of the 8x8x8 cell
+    it falls into (see ColorScheme._getCellCandidates), or just the candidates for the closest color
+    when nothing is excluded. The whole palette is searched when the color is outside of the cells.
+    """
+    lo = -_CELL_MARGIN
+    hi = 255 + _CELL_MARGIN
+    if lo <= cr <= hi and lo <= cg <= hi and lo <= cb <= hi:
+        cell = (((cr - lo) >> 3) * _CELLS + ((cg - lo) >> 3)) * _CELLS + ((cb - lo) >> 3)
+        if exclude1 == -1 and exclude2 == -1:
+            stop = offsets[2*cell + 1]
+        else:
+            stop = offsets[2*cell + 2]
+        bestdist = np.iinfo(np.int64).max
+        bestidx = -1
+        for n in range(offsets[2*cell], stop):
+            k = candidates[n]
+            if k == exclude1 or k == exclude2:
+                continue
+            dr = cr - np.int64(palette[k, 0])
+            dg = cg - np.int64(palette[k, 1])
+            db = cb - np.int64(palette[k, 2])
+            d = dr*dr + dg*dg + db*db
+            # the candidates aren't in palette order, so ties go to the lower index explicitly
+            if d < bestdist or (d == bestdist and k < bestidx):
+                bestdist = d
+                bestidx = k
+        return bestidx
+    return _argmin_palette(cr, cg, cb, palette, exclude1, exclude2)
+
+
+@njit(cache=True, fastmath=True)
+def _fs_kernel(image, palette, offsets, candidates, out, use_exclusion, verbose):  # type: ignore
+    """
+    Serpentine Floyd-Steinberg loop over a C-contiguous uint8 image of shape (rows, columns, C) with
+    a uint8 palette of shape (K, 3) and its cell candidates, using the first three channels of the
+    image. Writes the dithered image to out (uint8, shape (rows, columns, 3)). With use_exclusion
+    set, a pixel never gets the same color as the pixel before it or above it; neighboring pixels
+    are compared by palette index rather than by color.
+    Errors are kept in 1/16 units, so the Floyd-Steinberg weights are plain integer multiples. The
+    share for the next pixel of the row stays in a local variable, and the shares for the next row
+    are summed in local variables until all three pixels above an entry are done, so the next row's
+    buffer is written once per pixel and never read back.
+    """
+    rows, cols, _ = image.shape
+    # error of the current and the next row. both have a pixel of padding on either
+    # side (so pixel x is at x+1), which absorbs the shares that fall off the edges.
+    currow = np.zeros((cols + 2, 3), dtype=np.int32)
+    nextrow = np.zeros((cols + 2, 3), dtype=np.int32)
+    # palette index of each pixel in the previous row, -1 if there is none
+    prevrow = np.full(cols, -1, dtype=np.int32)
+    for y in range(rows):
+        if verbose and y % 10 == 0:
+            print("on row", y, "of", rows)
+        # even rows go left to right, odd rows right to left
+        if y % 2 == 0:
+            start, stop, step = 0, cols, 1
+        else:
+            start, stop, step = cols-1, -1, -1
+        left = -1
+        # error carried to the next pixel of this row
+        aheadr = aheadg = aheadb = 0
+        # partial errors of the pixels below the current pixel and below the one behind it
+        belowr = belowg = belowb = 0
+        behindr = behindg = behindb = 0
+        for x in range(start, stop, step):
+            # round the accumulated error to whole color units
+            cr = np.int32(image[y, x, 0]) + ((currow[x+1, 0] + aheadr + 8) >> 4)
+            cg = np.int32(image[y, x, 1]) + ((currow[x+1, 1] + aheadg + 8) >> 4)
+            cb = np.int32(image[y, x, 2]) + ((currow[x+1, 2] + aheadb + 8) >> 4)
+            # notouch rule for horizontally or vertically adjacent squares
+            if use_exclusion:
+                bestidx = _lookup_palette(cr, cg, cb, palette, offsets, candidates, left, prevrow[x])
+            else:
+                bestidx = _lookup_palette(cr, cg, cb, palette, offsets, candidates, -1, -1)
+            if bestidx == -1:
+                raise RuntimeError("Tried to get closest with exclusion, but all available colors were used.")
+            out[y, x, 0] = palette[bestidx, 0]
+            out[y, x, 1] = palette[bestidx, 1]
+            out[y, x, 2] = palette[bestidx, 2]
+            left = bestidx
+            prevrow[x] = bestidx
+            er = cr - palette[bestidx, 0]
+            eg = cg - palette[bestidx, 1]
+            eb = cb - palette[bestidx, 2]
+            aheadr, aheadg, aheadb = 7*er, 7*eg, 7*eb
+            # the pixel below and behind has now got all of its shares
+            nextrow[x+1-step, 0] = behindr + 3*er
+            nextrow[x+1-step, 1] = behindg + 3*eg
+            nextrow[x+1-step, 2] = behindb + 3*eb
+            behindr, behindg, behindb = belowr + 5*er, belowg + 5*eg, belowb + 5*eb
+            belowr, belowg, belowb = er, eg, eb
+        if cols > 0:
+            # the pixel below the last one has no pixel ahead of it
+            nextrow[stop-step+1, 0] = behindr
+            nextrow[stop-step+1, 1] = behindg
+            nextrow[stop-step+1, 2] = behindb
+        currow, nextrow = nextrow, currow
+
+
+@njit(cache=True, parallel=True, fastmath=True)
+def _fs_wavefront_kernel(image, palette, offsets, candidates, out, error, use_exclusion, verbose, tilerows, tilecols):  # type: ignore
+    """
+    Floyd-Steinberg loop in raster order (every row left to right) which runs on several threads.
+    Pixel (y, x) only depends on (y, x-1) and (y-1, x-1) to (y-1, x+1), which all come before it in
+    both y and u = x + y. So the image is cut into tiles of tilerows rows by tilecols values of u, and
+    tile (i, j) only depends on tiles (i-1, j), (i, j-1) and (i-1, j-1). The tiles with the same
+    i + j are processed at once, each by one thread in raster order, so the threads only wait for
+    each other once per diagonal of tiles. Each pixel pulls the error from the pixels it depends on
+    instead of pushing its own error forward, so no two threads ever write to the same place.
+    error (int16, same shape as out) holds the error of each processed pixel in whole color units.
+    use_exclusion works as in _fs_kernel, and verbose prints a line per diagonal.
+    """
+    rows, cols, _ = image.shape
+    indices = np.empty((rows, cols), dtype=np.int32)
+    # exceptions can't be raised from inside prange, so failures are collected here
+    failed = np.zeros(1, dtype=np.bool_)
+    # u runs from 0 to rows + cols - 2
+    nrowtiles = (rows + tilerows - 1) // tilerows
+    ncoltiles = (rows + cols - 1 + tilecols - 1) // tilecols
+    nsteps = nrowtiles + ncoltiles - 1
+    for t in range(nsteps):
+        if verbose:
+            print("on diagonal", t, "of", nsteps)
+        firsti = max(0, t - ncoltiles + 1)
+        lasti = min(nrowtiles - 1, t)
+        for n in prange(lasti - firsti + 1):
+            i = firsti + n
+            j = t - i
+            for y in range(i * tilerows, min(rows, (i+1) * tilerows)):
+                for x in range(max(0, j*tilecols - y), min(cols, (j+1)*tilecols - y)):
+                    # the error of the neighbors in 1/16 units
+                    sr = sg = sb = 0
+                    left = -1
+                    up = -1
+                    if x >= 1:
+                        sr += 7 * error[y, x-1, 0]
+                        sg += 7 * error[y, x-1, 1]
+                        sb += 7 * error[y, x-1, 2]
+                        left = indices[y, x-1]
+                    if y >= 1:
+                        if x+1 < cols:
+                            sr += 3 * error[y-1, x+1, 0]
+                            sg += 3 * error[y-1, x+1, 1]
+                            sb += 3 * error[y-1, x+1, 2]
+                        sr += 5 * error[y-1, x, 0]
+                        sg += 5 * error[y-1, x, 1]
+                        sb += 5 * error[y-1, x, 2]
+                        if x >= 1:
+                            sr += error[y-1, x-1, 0]
+                            sg += error[y-1, x-1, 1]
+                            sb += error[y-1, x-1, 2]
+                        up = indices[y-1, x]
+                    cr = np.int32(image[y, x, 0]) + ((sr + 8) >> 4)
+                    cg = np.int32(image[y, x, 1]) + ((sg + 8) >> 4)
+                    cb = np.int32(image[y, x, 2]) + ((sb + 8) >> 4)
+                    # notouch rule for horizontally or vertically adjacent squares
+                    if use_exclusion:
+                        bestidx = _lookup_palette(cr, cg, cb, palette, offsets, candidates, left, up)
+                    else:
+                        bestidx = _lookup_palette(cr, cg, cb, palette, offsets, candidates, -1, -1)
+                    if bestidx == -1:
+                        failed[0] = True
+                        bestidx = 0
+                    indices[y, x] = bestidx
+                    out[y, x, 0] = palette[bestidx, 0]
+                    out[y, x, 1] = palette[bestidx, 1]
+                    out[y, x, 2] = palette[bestidx, 2]
+                    error[y, x, 0] = _saturate16(cr - palette[bestidx, 0])
+                    error[y, x, 1] = _saturate16(cg - palette[bestidx, 1])
+                    error[y, x, 2] = _saturate16(cb - palette[bestidx, 2])
+    if failed[0]:
+        raise RuntimeError("Tried to get closest with exclusion, but all available colors were used.")
+
+
+@njit(cache=True, parallel=True, fastmath=True)
+def _closest_kernel(image, palette, indices):  # type: ignore
+    """
+    Writes the palette index of the closest color to every pixel of a uint8 image of shape
+    (rows, columns, C >= 3) to indices, an int32 array of shape (rows, columns).
+    Pixels are independent of each other, so rows are split between numba's threads (the number of
+    threads can be set with the NUMBA_NUM_THREADS environment variable).
+    """
+    rows, cols, _ = image.shape
+    for y in prange(rows):
+        for x in range(cols):
+            indices[y, x] = _argmin_palette(np.int64(image[y, x, 0]), np.int64(image[y, x, 1]), np.int64(image[y, x, 2]), palette, -1, -1)
+
+
+@njit(cache=True, parallel=True, fastmath=True)
+def _closest_lut_kernel(image, palette, offsets, candidates, out):  # type: ignore
+    """
+    Writes the closest palette color to every pixel of a uint8 image of shape (rows, columns, C >= 3)
+    to out (uint8, shape (rows, columns, 3)), only comparing each pixel against the candidates of
+    its cell (see ColorScheme._getCellCandidates).
+    """
+    rows, cols, _ = image.shape
+    for y in prange(rows):
+        for x in range(cols):
+            bestidx = _lookup_palette(np.int64(image[y, x, 0]), np.int64(image[y, x, 1]), np.int64(image[y, x, 2]),
+                                      palette, offsets, candidates, -1, -1)
+            out[y, x, 0] = palette[bestidx, 0]
+            out[y, x, 1] = palette[bestidx, 1]
+            out[y, x, 2] = palette[bestidx, 2]
+
+
+@njit(cache=True, parallel=True, fastmath=True)
+def _cell_count_kernel(near, far, reach, counts):  # type: ignore
+    """
+    near and far (int64, shape (3, _CELLS, K)) hold the smallest and the largest squared distance
+    along each channel from every range of cells to every palette entry. For each cell, writes to
+    reach[cell, 0] the smallest far distance of any palette entry and to reach[cell, 1] the
+    _CELL_RANKS-th smallest (so no value in the cell is further than that from its closest color,
+    or from its _CELL_RANKS closest colors). counts[cell, 0] is the number of palette entries whose
+    near distance is within reach[cell, 0], and counts[cell, 1] the number of further entries whose
+    near distance is within reach[cell, 1].
+    """
+    ncells = near.shape[1]
+    nranks = min(_CELL_RANKS, near.shape[2])
+    for cell in prange(ncells * ncells * ncells):
+        i, j, k = cell // (ncells * ncells), cell // ncells % ncells, cell % ncells
+        # the nranks smallest far distances, in increasing order
+        best = np.full(nranks, np.iinfo(np.int64).max, dtype=np.int64)
+        for n in range(near.shape[2]):
+            d = far[0, i, n] + far[1, j, n] + far[2, k, n]
+            pos = nranks
+            while pos > 0 and d < best[pos-1]:
+                pos -= 1
+                if pos < nranks - 1:
+                    best[pos+1] = best[pos]
+            if pos < nranks:
+                best[pos] = d
+        reach[cell, 0] = best[0]
+        reach[cell, 1] = best[nranks-1]
+        counts[cell, 0] = counts[cell, 1] = 0
+        for n in range(near.shape[2]):
+            d = near[0, i, n] + near[1, j, n] + near[2, k, n]
+            if d <= reach[cell, 0]:
+                counts[cell, 0] += 1
+            elif d <= reach[cell, 1]:
+                counts[cell, 1] += 1
+
+
+@njit(cache=True, parallel=True, fastmath=True)
+def _cell_fill_kernel(near, reach, offsets, candidates):  # type: ignore
+    """
+    Writes the candidates counted by _cell_count_kernel to candidates, each group in palette order
+    and starting at offsets[2*cell] and offsets[2*cell + 1].
+    """
+    ncells = near.shape[1]
+    for cell in prange(ncells * ncells * ncells):
+        i, j, k = cell // (ncells * ncells), cell // ncells % ncells, cell % ncells
+        closest = offsets[2*cell]
+        further = offsets[2*cell + 1]
+        for n in range(near.shape[2]):
+            d = near[0, i, n] + near[1, j, n] + near[2, k, n]
+            if d <= reach[cell, 0]:
+                candidates[closest] = n
+                closest += 1
+            elif d <= reach[cell, 1]:
+                candidates[further] = n
+                further += 1
+
+
+def _to_pixels(image: ColorLike) -> npt.NDArray[np.uint8]:
+    """
+    Returns the first three channels of an image as a C-contiguous uint8 array for the kernels.
+    Values outside of 0 to 255 are clipped (and other numbers rounded) instead of wrapping around.
+    """
+    if image.dtype != np.uint8:
+        image = np.clip(np.rint(image[..., :3]), 0, 255)
+    return np.ascontiguousarray(image[..., :3], dtype=np.uint8)
 
 
 class ColorScheme:
-    colors: npt.NDArray[np.int32]  # shape (_, 3)
+    colors: npt.NDArray[np.int16]  # shape (_, 3)
+    _colorToIdx: dict[tuple[int, ...], int]  # position of each color in self.colors
+    _palette: npt.NDArray[np.uint8]  # self.colors as a C-contiguous uint8 array, for the kernels and results
+    _pyList: list[tuple[int, int, int]]  # self.colors as python ints, for scalar arithmetic
+    _cellCandidates: Optional[tuple[npt.NDArray[np.int64], npt.NDArray[np.int16]]]  # see _getCellCandidates
 
     def __init__(self, *colors: tuple[int, int, int]):
         # self.colors has the wrong dimension if the colors parameter
@@ -82,36 +413,112 @@ class ColorScheme:
         # just assume that colors is non-empty.
         if len(colors) == 0:
             raise RuntimeError("Must have at least one color.")
-        self.colors = np.array(colors)
-
-    def getClosest(self, othercolor: ColorLike) -> ColorLike:
+        self._setColors(np.array(colors, dtype=np.int16))
+
+    def _setColors(self, colors: npt.NDArray[np.int16]) -> None:
+        if np.any((colors < 0) | (colors > 255)):
+            raise RuntimeError("Colors must be between 0 and 255.")
+        # colors are excluded by palette index, so a duplicate would slip past the notouch rule.
+        # keep the first copy of every color, in the original order
+        _, first = np.unique(colors, axis=0, return_index=True)
+        colors = colors[np.sort(first)]
+        self.colors = colors
+        self._palette = np.ascontiguousarray(colors, dtype=np.uint8)
+        # plain python numbers are much faster than numpy scalars for a few arithmetic operations
+        self._pyList = [(int(color[0]), int(color[1]), int(color[2])) for color in colors]
+        self._colorToIdx = {color: idx for idx, color in enumerate(self._pyList)}
+        self._cellCandidates = None
+
+    def _getCellCandidates(self) -> tuple[npt.NDArray[np.int64], npt.NDArray[np.int16]]:
+        """
+        Splits the RGB values from -_CELL_MARGIN to 255 + _CELL_MARGIN into cubic cells of 8x8x8
+        values, and lists the palette entries that can be one of the _CELL_RANKS closest colors to
+        some value in each cell: every entry whose nearest point in the cell is no further than the
+        furthest point in the cell is from _CELL_RANKS entries. These are usually only a handful, and
+        as the notouch rule excludes at most two colors, the closest allowed color is always among
+        them. The margin covers most of the colors that error diffusion pushes a little outside the
+        RGB cube.
+        Returns offsets and candidates, where the candidates of the cell with index
+        (((r + _CELL_MARGIN) >> 3) * _CELLS + ((g + _CELL_MARGIN) >> 3)) * _CELLS + ((b + _CELL_MARGIN) >> 3)
+        are candidates[offsets[2*cell]:offsets[2*cell + 2]]. The ones that can be the closest color
+        come first, up to offsets[2*cell + 1]. They are built the first time they are needed.
+        """
+        if self._cellCandidates is None:
+            lo = np.arange(_CELLS, dtype=np.int64)[None, :, None] * 8 - _CELL_MARGIN
+            hi = lo + 7
+            channels = self._palette.T.astype(np.int64)[:, None, :]
+            near = np.ascontiguousarray((np.maximum(lo - channels, 0) + np.maximum(channels - hi, 0)) ** 2)
+            far = np.ascontiguousarray(np.maximum(channels - lo, hi - channels) ** 2)
+            reach = np.empty((_CELLS ** 3, 2), dtype=np.int64)
+            counts = np.empty((_CELLS ** 3, 2), dtype=np.int64)
+            _cell_count_kernel(near, far, reach, counts)
+            offsets = np.zeros(2 * _CELLS ** 3 + 1, dtype=np.int64)
+            np.cumsum(counts.reshape(-1), out=offsets[1:])
+            candidates = np.empty(offsets[-1], dtype=np.int16)
+            _cell_fill_kernel(near, reach, offsets, candidates)
+            self._cellCandidates = (offsets, candidates)
+        return self._cellCandidates
+
+    def _closestIndex(self, cr: float, cg: float, cb: float, mask: int = 0) -> int:
+        """
+        Returns the index of the color closest to (cr, cg, cb), skipping every index whose bit is
+        set in mask. Returns -1 if all colors are excluded.
+        """
         bestdist = float("inf")
-        newcolor: ColorLike
-        for newcolor in self.colors:
-            dist = np.sum(np.square(newcolor-othercolor))
+        bestidx = -1
+        for idx, (r, g, b) in enumerate(self._pyList):
+            if mask >> idx & 1:
+                continue
+            dist = (r-cr)**2 + (g-cg)**2 + (b-cb)**2
             if dist < bestdist:
                 bestdist = dist
-                bestcolor = newcolor
-        return bestcolor  # type: ignore
+                bestidx = idx
+        return bestidx
+
+    def getClosest(self, othercolor: ColorLike) -> ColorLike:
+        cr, cg, cb = (float(channel) for channel in othercolor)
+        closest: ColorLike = self._palette[self._closestIndex(cr, cg, cb)]
+        return closest
 
     def getClosestWithExclusion(self, othercolor: ColorLike, notcolors: list[ColorLike]) -> ColorLike:
-        bestdist = float("inf")
-        newcolor: ColorLike
-        bestcolor = None
-        for newcolor in self.colors:
-            if isin(newcolor, notcolors):
-                continue
-            dist = np.sum(np.square(newcolor-othercolor))
-            if dist < bestdist:
-                bestdist = dist
-                bestcolor = newcolor
-        if bestcolor is None:
+        # excluded colors are tracked as a bitmask of palette indices. colors which are
+        # not in the palette can never be picked, so they don't need to be excluded.
+        mask = 0
+        for notcolor in notcolors:
+            notidx = self._colorToIdx.get(tuple(np.asarray(notcolor).tolist()))
+            if notidx is not None:
+                mask |= 1 << notidx
+        cr, cg, cb = (float(channel) for channel in othercolor)
+        bestidx = self._closestIndex(cr, cg, cb, mask)
+        if bestidx == -1:
             raise RuntimeError("Tried to get closest with exclusion, but all available colors were used.")
-        return bestcolor
+        closest: ColorLike = self._palette[bestidx]
+        return closest
+
+    def getClosestBatch(self, image: ColorLike) -> ColorLike:
+        """
+        Returns the closest color for every pixel of an image of shape (_, _, 3) at once. Any
+        further channels, like alpha, are ignored.
+        """
+        indices = np.empty(image.shape[:2], dtype=np.int32)
+        _closest_kernel(_to_pixels(image), self._palette, indices)
+        closest: ColorLike = self._palette[indices]
+        return closest
+
+    def getClosestLut(self, image: ColorLike) -> ColorLike:
+        """
+        Same as getClosestBatch, but only compares every pixel against the few colors that can be
+        closest to it (see _getCellCandidates), which is much faster for large color schemes.
+        """
+        closest = np.empty(image.shape[:2] + (3,), dtype=np.uint8)
+        offsets, candidates = self._getCellCandidates()
+        _closest_lut_kernel(_to_pixels(image), self._palette, offsets, candidates, closest)
+        return closest
 
 
 class UniformColorScheme(ColorScheme):
-    shades: npt.NDArray[np.int32]  # shape (_)
+    shades: npt.NDArray[np.int16]  # shape (_)
+    _lut: npt.NDArray[np.uint8]  # shape (256), closest shade to each channel value
 
     def __init__(self, *shades: int):
         # self.shades has the wrong dimension if the shades parameter
@@ -119,30 +526,25 @@ class UniformColorScheme(ColorScheme):
         # just assume that shades is non-empty.
         if len(shades) == 0:
             raise RuntimeError("Must have at least one shade.")
-        self.shades = np.array(shades)
-        shadeR: int
-        shadeG: int
-        shadeB: int
-        colorlist = []
-        for shadeR in shades:
-            for shadeG in shades:
-                for shadeB in shades:
-                    newcolor = np.array((shadeR, shadeG, shadeB))
-                    colorlist.append(newcolor)
-        self.colors = np.array(colorlist)
+        self.shades = np.asarray(shades, dtype=np.int16)
+        # every combination of shades, with red varying slowest and blue fastest
+        grid = np.stack(np.meshgrid(self.shades, self.shades, self.shades, indexing="ij"), axis=-1)
+        self._setColors(np.ascontiguousarray(grid.reshape(-1, 3)))
+        values = np.arange(256)
+        self._lut = self.shades[np.argmin(np.abs(values[:, None] - self.shades[None, :]), axis=1)].astype(np.uint8)
 
     def getClosest(self, othercolor: ColorLike) -> ColorLike:
-        bestcolor = np.zeros(3, dtype=np.int32)
-        for i in range(3):
-            bestdist = float("inf")
-            bestshade = None
-            for newshade in self.shades:
-                dist = abs(newshade - othercolor[i])
-                if dist < bestdist:
-                    bestdist = dist
-                    bestshade = newshade
-                bestcolor[i] = bestshade
-        return bestcolor
+        closest: ColorLike = self._lut[np.clip(np.rint(othercolor), 0, 255).astype(np.intp)]
+        return closest
+
+    def getClosestBatch(self, image: ColorLike) -> ColorLike:
+        # the channels are independent, so a single table lookup per channel is enough
+        closest: ColorLike = self._lut[_to_pixels(image)]
+        return closest
+
+    def getClosestLut(self, image: ColorLike) -> ColorLike:
+        # the per-channel table is already exact and just as fast
+        return self.getClosestBatch(image)
 
 
 # List of available color schemes
@@ -182,83 +584,51 @@ def dither_do_nothing(image: ColorLike, colorscheme: ColorScheme, verbose: bool)
 
 def dither_closest(image: ColorLike, colorscheme: ColorScheme, verbose: bool) -> ColorLike:
     """
-    Replaces each pixel with its closes valid color
+    Replaces each pixel with its closes valid color (see ColorScheme.getClosestLut)
     """
-    width, height, _ = image.shape
-    for j in range(height):
-        if verbose and j % 10 == 0:
-            print("on row", j, "of", height)
-        for i in range(width):
-            color = image[i, j]
-            image[i, j] = colorscheme.getClosest(color)
-    return image
+    return colorscheme.getClosestLut(image)
 
 
-def dither_floyd_steinberg(image: ColorLike, colorscheme: ColorScheme, verbose: bool) -> ColorLike:
+def _error_diffusion(image: ColorLike, colorscheme: ColorScheme, verbose: bool, parallel: bool, use_exclusion: bool) -> ColorLike:
     """
-    Applies floyd-steinberg dithering to an image
+    Runs one of the Floyd-Steinberg kernels, shared by dither_floyd_steinberg and dither_no_touch
     """
-    width, height, _ = image.shape
-    newimage = np.empty((width, height, 3), dtype=np.int32)
-    error = np.zeros((width, height, 3))
-    for j in range(height):
-        if verbose and j % 10 == 0:
-            print("on row", j, "of", height)
-        for i in range(width):
-            color = image[i, j] + error[i, j]
-            # notouch rule for horizontally or vertically adjacent squares
-            excludedcolors = []
-            if i >= 1:
-                excludedcolors.append(newimage[i-1, j])
-            if j >= 1:
-                excludedcolors.append(newimage[i, j-1])
-            newcolor = colorscheme.getClosestWithExclusion(color, excludedcolors)
-            newimage[i, j] = newcolor
-            extracolor = color - newcolor
-            if i+1 < width:
-                error[i+1, j] += extracolor*7/16
-            if i-1 >= 0 and j-1 >= 0:
-                error[i-1, j-1] += extracolor*3/16
-            if j-1 >= 0:
-                error[i, j-1] += extracolor*5/16
-            if i+1 < width and j-1 >= 0:
-                error[i+1, j-1] += extracolor*1/16
+    newimage = np.empty(image.shape[:2] + (3,), dtype=np.uint8)
+    pixels = _to_pixels(image)
+    offsets, candidates = colorscheme._getCellCandidates()
+    if parallel:
+        error = np.zeros(newimage.shape, dtype=np.int16)
+        _fs_wavefront_kernel(pixels, colorscheme._palette, offsets, candidates, newimage, error, use_exclusion, verbose,
+                             _TILE_ROWS, _TILE_COLUMNS)
+    else:
+        _fs_kernel(pixels, colorscheme._palette, offsets, candidates, newimage, use_exclusion, verbose)
     return newimage
 
 
-def dither_no_touch(image: ColorLike, colorscheme: ColorScheme, verbose: bool) -> ColorLike:
+def dither_floyd_steinberg(image: ColorLike, colorscheme: ColorScheme, verbose: bool, parallel: bool = False) -> ColorLike:
+    """
+    Applies floyd-steinberg dithering to an image.
+    The image is scanned along its last spatial axis, which is contiguous in memory for arrays
+    coming from PIL, alternating direction on every row (serpentine order).
+    This runs on a single core, since each pixel depends on the error left over from the
+    pixels before it. With parallel set, every row is instead scanned left
+    to right, which lets blocks of the image be processed on several cores as a staggered
+    wavefront (see _fs_wavefront_kernel).
+    """
+    return _error_diffusion(image, colorscheme, verbose, parallel, False)
+
+
+def dither_no_touch(image: ColorLike, colorscheme: ColorScheme, verbose: bool, parallel: bool = False) -> ColorLike:
     """
     Applies Floyd-Steinberg dithering, but no two tiles can touch.
     """
-    width, height, _ = image.shape
-    newimage = np.empty((width, height, 3), dtype=np.int32)
-    error = np.zeros((width, height, 3))
-    for j in range(height):
-        if verbose and j % 10 == 0:
-            print("on row", j, "of", height)
-        for i in range(width):
-            color = image[i, j] + error[i, j]
-            # notouch rule for horizontally or vertically adjacent squares
-            excludedcolors = []
-            if i >= 1:
-                excludedcolors.append(newimage[i-1, j])
-            if j >= 1:
-                excludedcolors.append(newimage[i, j-1])
-            newcolor = colorscheme.getClosestWithExclusion(color, excludedcolors)
-            newimage[i, j] = newcolor
-            extracolor = color - newcolor
-            if i+1 < width:
-                error[i+1, j] += extracolor*7/16
-            if i-1 >= 0 and j-1 >= 0:
-                error[i-1, j-1] += extracolor*3/16
-            if j-1 >= 0:
-                error[i, j-1] += extracolor*5/16
-            if i+1 < width and j-1 >= 0:
-                error[i+1, j-1] += extracolor*1/16
-    return newimage
+    return _error_diffusion(image, colorscheme, verbose, parallel, True)
 
 
-if __name__ == "__main__":
+def main() -> None:
+    """
+    Runs the command line program, reading its arguments from sys.argv.
+    """
     # default values
     if len(sys.argv) <= 1:
         on_usage_error()
@@ -316,10 +686,10 @@ if __name__ == "__main__":
     # actual dithering begins here
     try:
         with Image.open(inputpath) as im:
-            bmp = np.array(im, dtype=np.int32)  # shape (width, height, 3)
+            bmp = np.asarray(im.convert("RGB"))  # uint8, shape (height, width, 3)
             if verbose:
                 print(f"shape: {bmp.shape[0]} by {bmp.shape[1]}")
-            width, height, _ = bmp.shape
+            height, width, _ = bmp.shape
 
             if verbose:
                 print("starting image processing")
@@ -327,10 +697,14 @@ if __name__ == "__main__":
             if verbose:
                 print("finished processing image")
 
-            output = Image.fromarray(newbmp.astype(np.uint8))
+            output = Image.fromarray(newbmp)
             output.save(outputpath)
             if verbose:
                 print(f"Image saved to {outputpath}")
     except FileNotFoundError:
         # input file does not exists
         on_file_error(inputpath)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,10 +3,13 @@ Test package for dither.py
 These tests run automatically with when pytest is run.
 """
 
+import functools
+
 import numpy as np
 import numpy.typing as npt
 import pytest
 from dithering.dither import ColorScheme, UniformColorScheme, dither_closest, dither_do_nothing, dither_floyd_steinberg, dither_no_touch, isin
+from dithering.dither import _fs_wavefront_kernel
 
 
 def test_isin_simple():
@@ -33,6 +36,7 @@ def test_get_closest_1():
     assert np.array_equal(cs.getClosest(white), white)
     assert np.array_equal(cs.getClosestWithExclusion(white, []), white)
     assert np.array_equal(cs.getClosestWithExclusion(white, [black]), white)
+    assert cs.getClosest(black).dtype == np.uint8
 
 
 def test_get_closest_2():
@@ -48,6 +52,58 @@ def test_get_closest_2():
     assert np.array_equal(cs.getClosest(white), white)
     assert np.array_equal(cs.getClosestWithExclusion(white, []), white)
     assert np.array_equal(cs.getClosestWithExclusion(white, [pink]), white)
+    assert cs.getClosest(black).dtype == np.uint8
+
+
+@pytest.mark.parametrize("cs", [
+    ColorScheme((0, 0, 0), (0, 0, 0), (255, 255, 255)),
+    UniformColorScheme(0, 0, 255)
+])
+def test_duplicate_colors(cs):
+    black = np.array((0, 0, 0))
+    assert len(cs.colors) == len({tuple(color) for color in cs.colors.tolist()})
+    assert not np.array_equal(cs.getClosestWithExclusion(black, [black]), black)
+    result = dither_no_touch(np.zeros((2, 2, 3)), cs, False)
+    for i, j in [(0, 0), (1, 1)]:
+        assert not np.array_equal(result[i, j], result[1-i, j])
+        assert not np.array_equal(result[i, j], result[i, 1-j])
+
+
+def test_duplicate_colors_no_touch():
+    cs = ColorScheme((0, 0, 0), (0, 0, 0), (255, 255, 255))
+    result = dither_no_touch(np.zeros((2, 2, 3)), cs, False)
+    assert np.array_equal(result[..., 0], [[0, 255], [255, 0]])
+
+
+@pytest.mark.parametrize("cs", [
+    ColorScheme((0, 0, 0), (255, 255, 255), (255, 0, 0)),
+    UniformColorScheme(0, 100, 255)
+])
+@pytest.mark.parametrize("dtype", [np.int64, np.uint8, np.float64])
+def test_get_closest_batch(cs, dtype):
+    rng = np.random.default_rng(0)
+    sample_picture = rng.integers(0, 256, size=(4, 5, 3)).astype(dtype)
+    result = cs.getClosestBatch(sample_picture)
+    assert result.shape == sample_picture.shape
+    assert result.dtype == np.uint8
+    for i in range(4):
+        for j in range(5):
+            assert np.array_equal(result[i, j], cs.getClosest(sample_picture[i, j]))
+
+
+@pytest.mark.parametrize("cs", [
+    ColorScheme((0, 0, 0), (255, 255, 255), (255, 0, 0), (30, 200, 90)),
+    # closer together than the cells of the lookup
+    ColorScheme((0, 0, 0), (6, 6, 6), (255, 255, 255)),
+    ColorScheme(*(tuple(color) for color in np.random.default_rng(0).integers(0, 256, size=(200, 3)).tolist()))
+])
+def test_get_closest_lut(cs):
+    # every color of the scheme is its own closest color
+    palette = cs.colors.reshape(1, -1, 3)
+    assert np.array_equal(cs.getClosestLut(palette), palette)
+    rng = np.random.default_rng(1)
+    sample_picture = rng.integers(0, 256, size=(64, 64, 3))
+    assert np.array_equal(cs.getClosestLut(sample_picture), cs.getClosestBatch(sample_picture))
 
 
 @pytest.fixture()
@@ -59,7 +115,9 @@ def colorscheme():
 IMAGE_ACTIONS = [
     dither_closest,
     dither_floyd_steinberg,
-    dither_no_touch
+    dither_no_touch,
+    functools.partial(dither_floyd_steinberg, parallel=True),
+    functools.partial(dither_no_touch, parallel=True)
 ]
 
 
@@ -114,3 +172,108 @@ def test_dither_succeeds(image_action, colorscheme):
     for i in range(width):
         for j in range(height):
             assert isin(result[i, j], colorscheme.colors)
+
+
+def test_dither_ignores_alpha(image_action, colorscheme):
+    sample_picture = np.full((2, 3, 4), 255)
+    sample_picture[..., :3] = 100
+    result = image_action(sample_picture, colorscheme, False)
+    assert result.shape == (2, 3, 3)
+    for i in range(2):
+        for j in range(3):
+            assert isin(result[i, j], colorscheme.colors)
+
+
+@pytest.mark.parametrize("cs", [
+    ColorScheme((0, 0, 0), (255, 0, 0), (0, 255, 0), (0, 0, 255), (255, 255, 255)),
+    UniformColorScheme(0, 120, 255)
+])
+def test_dither_clips_out_of_range(image_action, cs):
+    sample_picture = np.array([[[300, -5, 128]]])
+    result = image_action(sample_picture, cs, False)
+    assert np.array_equal(result[0, 0], cs.getClosest(np.array((255, 0, 128))))
+
+
+@pytest.mark.parametrize("parallel", [False, True])
+def test_floyd_steinberg_keeps_exact_colors(colorscheme, parallel):
+    sample_picture = np.full((4, 5, 3), 100)
+    result = dither_floyd_steinberg(sample_picture, colorscheme, False, parallel=parallel)
+    assert np.array_equal(result, sample_picture)
+
+
+@pytest.mark.parametrize("parallel", [False, True])
+def test_floyd_steinberg_keeps_close_colors(parallel):
+    cs = ColorScheme((0, 0, 0), (6, 6, 6), (255, 255, 255))
+    sample_picture = np.zeros((4, 5, 3))
+    result = dither_floyd_steinberg(sample_picture, cs, False, parallel=parallel)
+    assert np.array_equal(result, sample_picture)
+
+
+@pytest.mark.parametrize("parallel", [False, True])
+def test_no_touch(colorscheme, parallel):
+    sample_picture = np.full((4, 5, 3), 100)
+    result = dither_no_touch(sample_picture, colorscheme, False, parallel=parallel)
+    height, width, _ = result.shape
+    for i in range(height):
+        for j in range(width):
+            if i+1 < height:
+                assert not np.array_equal(result[i, j], result[i+1, j])
+            if j+1 < width:
+                assert not np.array_equal(result[i, j], result[i, j+1])
+
+
+@pytest.mark.parametrize("use_exclusion", [False, True])
+@pytest.mark.parametrize("tiles", [(1, 1), (2, 3), (7, 4)])
+def test_wavefront_tiles(use_exclusion, tiles):
+    cs = ColorScheme((0, 0, 0), (255, 0, 0), (0, 255, 0), (0, 0, 255), (255, 255, 255))
+    rng = np.random.default_rng(0)
+    sample_picture = rng.integers(0, 256, size=(20, 30, 3), dtype=np.uint8)
+    offsets, candidates = cs._getCellCandidates()
+
+    def run(tilerows, tilecols):
+        result = np.empty_like(sample_picture)
+        error = np.zeros(sample_picture.shape, dtype=np.int16)
+        _fs_wavefront_kernel(sample_picture, cs._palette, offsets, candidates, result, error, use_exclusion, False, tilerows, tilecols)
+        return result
+
+    # a single tile covers all rows and all values of x + y, and is processed in raster order
+    assert np.array_equal(run(*tiles), run(20, 20 + 30))
+
+
+def reference_floyd_steinberg(image, cs, use_exclusion):
+    """
+    Serpentine Floyd-Steinberg with the error kept in 1/16 units, one pixel at a time
+    """
+    rows, cols, _ = image.shape
+    # padded by one pixel on either side and one row below
+    error = np.zeros((rows + 1, cols + 2, 3), dtype=np.int64)
+    result = np.zeros((rows, cols, 3), dtype=np.int64)
+    for y in range(rows):
+        step = 1 if y % 2 == 0 else -1
+        for x in range(cols)[::step]:
+            color = image[y, x] + ((error[y, x+1] + 8) >> 4)
+            notcolors = []
+            if use_exclusion:
+                if 0 <= x - step < cols:
+                    notcolors.append(result[y, x-step])
+                if y > 0:
+                    notcolors.append(result[y-1, x])
+            result[y, x] = cs.getClosestWithExclusion(color, notcolors)
+            diff = color - result[y, x]
+            error[y, x+1+step] += 7 * diff
+            error[y+1, x+1-step] += 3 * diff
+            error[y+1, x+1] += 5 * diff
+            error[y+1, x+1+step] += diff
+    return result
+
+
+@pytest.mark.parametrize("use_exclusion", [False, True])
+def test_floyd_steinberg_matches_reference(use_exclusion):
+    cs = ColorScheme((0, 0, 0), (255, 0, 0), (0, 255, 0), (0, 0, 255), (255, 255, 255), (30, 200, 90))
+    rng = np.random.default_rng(0)
+    sample_picture = rng.integers(0, 256, size=(9, 13, 3))
+    if use_exclusion:
+        result = dither_no_touch(sample_picture, cs, False)
+    else:
+        result = dither_floyd_steinberg(sample_picture, cs, False)
+    assert np.array_equal(result, reference_floyd_steinberg(sample_picture, cs, use_exclusion))